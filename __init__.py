@@ -1,11 +1,20 @@
 import json
+import os
 import re
+import shutil
 import tempfile
+import threading
 import time
+import zlib
+from collections import defaultdict
+from collections.abc import Callable, Iterator
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.client import HTTPException, HTTPResponse, HTTPSConnection
 from pathlib import Path
 from typing import Any
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
 from urllib.request import Request, urlopen
 
 from albert import (  # pylint: disable=import-error
@@ -17,6 +26,11 @@ from albert import (  # pylint: disable=import-error
     setClipboardText,
 )
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 critical = globals().get('critical', lambda _: None)
 info = globals().get('info', lambda _: None)
@@ -28,8 +42,15 @@ md_description = 'TriggerQuery and open YouTube videos and channels'
 md_url = 'https://github.com/stevenxxiu/albert_youtube_steven'
 md_maintainers = '@stevenxxiu'
 
+QUERY_DELAY = 0.5
+MAX_WORKERS = 10
+CHUNK_SIZE = 64 * 1024
+HTTP_TIMEOUT = 5
+CACHE_MAX_AGE = 7 * 24 * 60 * 60
 ICON_URL = f'file:{Path(__file__).parent / "icons/youtube.svg"}'
-DATA_REGEX = re.compile(r'\b(var\s|window\[")ytInitialData("\])?\s*=\s*(.*?)\s*;</script>', re.MULTILINE)
+DATA_PREFIX = b'ytInitialData'
+DATA_SUFFIX = b';</script>'
+DATA_REGEX = re.compile(DATA_PREFIX + rb'"?\]?\s*=\s*(\{.*?\})\s*' + DATA_SUFFIX, re.DOTALL)
 
 HEADERS = {
     'User-Agent': (
@@ -52,51 +73,173 @@ def log_html(html: bytes) -> None:
 
 
 def urlopen_with_headers(url: str) -> Any:
-    req = Request(headers=HEADERS, url=url)
-    return urlopen(req)
+    req = Request(headers=HEADERS | {'Accept-Encoding': 'gzip'}, url=url)
+    return urlopen(req, timeout=HTTP_TIMEOUT)
+
+
+def read_body(response: Any, query: Any) -> tuple[bytes, dict | None] | None:
+    # Stop reading once the `ytInitialData` slice parses, as the rest of the page isn't needed. Otherwise read the whole
+    # page, so the regex fallback can find a later match. Returns `None` if the query is invalidated while reading.
+    decompressor = None
+    if response.headers.get('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = bytearray()
+    data_start = -1
+    scanning = True
+    while chunk := response.read(CHUNK_SIZE):
+        if not query.isValid:
+            return None
+        # Only scan the new bytes, plus enough overlap to catch a marker split across chunks
+        if data_start == -1:
+            scan_from = max(len(body) - len(DATA_PREFIX) + 1, 0)
+        else:
+            scan_from = max(len(body) - len(DATA_SUFFIX) + 1, data_start)
+        body += decompressor.decompress(chunk) if decompressor else chunk
+        if not scanning:
+            continue
+        if data_start == -1:
+            data_start = body.find(DATA_PREFIX, scan_from)
+            if data_start == -1:
+                continue
+            scan_from = data_start
+        if body.find(DATA_SUFFIX, scan_from) != -1:
+            results = parse_data_slice(body, data_start)
+            if results is not None:
+                return bytes(body), results
+            scanning = False
+    return bytes(body), None
+
+
+# Keeps HTTPS connections alive between requests, so downloads to the same host skip the TCP and TLS handshakes
+class ConnectionPool:
+    def __init__(self, max_idle: int) -> None:
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle: defaultdict[str, list[HTTPSConnection]] = defaultdict(list)
+
+    def _acquire(self, host: str) -> tuple[HTTPSConnection, bool]:
+        with self._lock:
+            idle = self._idle[host]
+            if idle:
+                return idle.pop(), True
+        return HTTPSConnection(host, timeout=HTTP_TIMEOUT), False
+
+    def _release(self, host: str, conn: HTTPSConnection) -> None:
+        with self._lock:
+            idle = self._idle[host]
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, host: str, target: str) -> tuple[HTTPSConnection, HTTPResponse]:
+        conn, reused = self._acquire(host)
+        try:
+            conn.request('GET', target, headers=HEADERS)
+            return conn, conn.getresponse()
+        except (HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+        # The server may have closed the idle connection, so retry once on a new one
+        conn = HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+        try:
+            conn.request('GET', target, headers=HEADERS)
+            return conn, conn.getresponse()
+        except (HTTPException, OSError):
+            conn.close()
+            raise
+
+    @contextmanager
+    def get(self, url: str) -> Iterator[HTTPResponse]:
+        parts = urlsplit(url)
+        target = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        conn, response = self._send(parts.netloc, target)
+        try:
+            if response.status != HTTPStatus.OK:
+                raise HTTPException(f'{url} returned {response.status} {response.reason}')
+            yield response
+        except BaseException:
+            conn.close()
+            raise
+        # The connection can only be reused once the response is fully read
+        if response.isclosed():
+            self._release(parts.netloc, conn)
+        else:
+            conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
 
 
 def text_from(val: dict[str, Any]) -> str:
-    text = val['simpleText'] if 'runs' not in val else ''.join(str(v['text']) for v in val['runs'])
+    runs = val.get('runs')
+    text = ''.join([v['text'] for v in runs]) if runs is not None else val['simpleText']
 
     return text.strip()
 
 
-def download_item_icon(item: StandardItem, temp_dir: Path) -> None:
+def parse_data_slice(response_bytes: bytes | bytearray, start: int) -> dict | None:
+    # The JSON follows a fixed literal, so slice it out directly rather than scanning the whole page with a regex
+    data_start = response_bytes.find(b'=', start) + 1
+    data_end = response_bytes.find(DATA_SUFFIX, data_start)
+    if data_end == -1:
+        return None
+    try:
+        return json_loads(response_bytes[data_start:data_end].strip())
+    except ValueError:
+        return None
+
+
+def parse_initial_data(response_bytes: bytes) -> dict | None:
+    start = response_bytes.find(DATA_PREFIX)
+    if start == -1:
+        # Likely a consent or captcha page, which the regex can't match either
+        return None
+
+    results = parse_data_slice(response_bytes, start)
+    if results is not None:
+        return results
+
+    match = DATA_REGEX.search(response_bytes, start)
+    if match is None:
+        return None
+    return json_loads(match.group(1))
+
+
+def clean_cache(cache_dir: Path) -> None:
+    # Remove downloads left behind by a crash, and expire old thumbnails, as they can change, e.g. for live streams
+    expire_time = time.time() - CACHE_MAX_AGE
+    for child in cache_dir.iterdir():
+        try:
+            if child.suffix == '.part' or child.stat().st_mtime < expire_time:
+                child.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def download_item_icon(item: StandardItem, cache_dir: Path, pool: ConnectionPool) -> None:
     url = item.iconUrls[0]
-    video_id = url.split('/')[-2]
-    path = temp_dir / f'{video_id}.png'
-    with urlopen_with_headers(url) as response, path.open('wb') as sr:
-        sr.write(response.read())
+    video_id = url.rsplit('/', 2)[-2]
+    path = cache_dir / f'{video_id}.png'
+    if not path.exists():
+        # Download to a temporary file first, so an interrupted download isn't cached
+        fd, temp_path = tempfile.mkstemp(suffix='.part', dir=cache_dir)
+        try:
+            with open(fd, 'wb') as sr, pool.get(url) as response:
+                shutil.copyfileobj(response, sr, CHUNK_SIZE)
+            Path(temp_path).replace(path)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
     item.iconUrls = [f'file:{path}']
 
 
-def entry_to_item(type_, data) -> StandardItem | None:
-    icon = ICON_URL
-    match type_:
-        case 'videoRenderer':
-            subtext = ['Video']
-            action = 'Watch on Youtube'
-            url_path = f'watch?v={data["videoId"]}'
-            if 'lengthText' in data:
-                subtext.append(text_from(data['lengthText']))
-            if 'shortViewCountText' in data:
-                subtext.append(text_from(data['shortViewCountText']))
-            if 'publishedTimeText' in data:
-                subtext.append(text_from(data['publishedTimeText']))
-            if data['thumbnail']['thumbnails']:
-                icon = data['thumbnail']['thumbnails'][0]['url'].split('?', 1)[0]
-        case 'channelRenderer':
-            subtext = ['Channel']
-            action = 'Show on Youtube'
-            url_path = f'channel/{data["channelId"]}'
-            if 'videoCountText' in data:
-                subtext.append(text_from(data['videoCountText']))
-            if 'subscriberCountText' in data:
-                subtext.append(text_from(data['subscriberCountText']))
-        case _:
-            return None
-
+def make_item(data: dict[str, Any], url_path: str, action: str, subtext: list[str], icon: str) -> StandardItem:
     title = text_from(data['title'])
     url = f'https://www.youtube.com/{url_path}'
     return StandardItem(
@@ -115,6 +258,44 @@ def entry_to_item(type_, data) -> StandardItem | None:
     )
 
 
+def video_to_item(data: dict[str, Any]) -> StandardItem:
+    subtext = ['Video']
+    append = subtext.append
+    if 'lengthText' in data:
+        append(text_from(data['lengthText']))
+    if 'shortViewCountText' in data:
+        append(text_from(data['shortViewCountText']))
+    if 'publishedTimeText' in data:
+        append(text_from(data['publishedTimeText']))
+    icon = ICON_URL
+    if data['thumbnail']['thumbnails']:
+        icon = data['thumbnail']['thumbnails'][0]['url'].partition('?')[0]
+    return make_item(data, f'watch?v={data["videoId"]}', 'Watch on Youtube', subtext, icon)
+
+
+def channel_to_item(data: dict[str, Any]) -> StandardItem:
+    subtext = ['Channel']
+    append = subtext.append
+    if 'videoCountText' in data:
+        append(text_from(data['videoCountText']))
+    if 'subscriberCountText' in data:
+        append(text_from(data['subscriberCountText']))
+    return make_item(data, f'channel/{data["channelId"]}', 'Show on Youtube', subtext, ICON_URL)
+
+
+RENDERERS: dict[str, Callable[[dict[str, Any]], StandardItem]] = {
+    'videoRenderer': video_to_item,
+    'channelRenderer': channel_to_item,
+}
+
+
+def entry_to_item(type_: str, data: dict[str, Any]) -> StandardItem | None:
+    renderer = RENDERERS.get(type_)
+    if renderer is None:
+        return None
+    return renderer(data)
+
+
 def results_to_items(results: dict) -> list[StandardItem]:
     items: list[StandardItem] = []
     for result in results:
@@ -136,31 +317,41 @@ class Plugin(PluginInstance, TriggerQueryHandler):
             self, id=__name__, name=md_name, description=md_description, synopsis='query', defaultTrigger='yt '
         )
         PluginInstance.__init__(self)
-        self.temp_dir = Path(tempfile.mkdtemp(prefix='albert_yt_'))
+        self.cache_dir = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'albert_youtube_steven'
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        clean_cache(self.cache_dir)
+        self._pool = ConnectionPool(MAX_WORKERS)
+        self._cancel_lock = threading.Lock()
+        self._cancel_event = threading.Event()
 
     def __del__(self) -> None:
-        for child in self.temp_dir.iterdir():
-            child.unlink()
-        self.temp_dir.rmdir()
+        self._pool.close()
 
     def handleTriggerQuery(self, query) -> None:
+        # A new query invalidates the previous one, so wake up its wait
+        with self._cancel_lock:
+            self._cancel_event.set()
+            cancel_event = self._cancel_event = threading.Event()
+
         query_str = query.string.strip()
         if not query_str:
             return
 
         # Avoid rate limiting
-        for _ in range(50):
-            time.sleep(0.01)
-            if not query.isValid:
-                return
+        if cancel_event.wait(QUERY_DELAY) or not query.isValid:
+            return
 
         info(f'Searching YouTube for \'{query_str}\'')
         url = f'https://www.youtube.com/results?{urlencode({"search_query": query_str})}'
 
         with urlopen_with_headers(url) as response:
-            response_bytes: bytes = response.read()
-            match = re.search(DATA_REGEX, response_bytes.decode())
-            if match is None:
+            body = read_body(response, query)
+            if body is None:
+                return
+            response_bytes, results = body
+            if results is None:
+                results = parse_initial_data(response_bytes)
+            if results is None:
                 critical(
                     'Failed to receive expected data from YouTube. This likely means API changes, but could just be a '
                     'failed request.'
@@ -168,26 +359,35 @@ class Plugin(PluginInstance, TriggerQueryHandler):
                 log_html(response_bytes)
                 return
 
-            results = json.loads(match.group(3))
             primary_contents = results['contents']['twoColumnSearchResultsRenderer']['primaryContents']
             contents = primary_contents['sectionListRenderer']['contents']
             items = []
             for content_item in contents:
                 items.extend(results_to_items(content_item.get('itemSectionRenderer', {}).get('contents', [])))
 
-            # Purge previous icons
-            for child in self.temp_dir.iterdir():
-                child.unlink()
-
-            # Download icons
-            with ThreadPoolExecutor(max_workers=10) as e:
-                for item in items:
-                    e.submit(download_item_icon, item, self.temp_dir)
+            # Download icons, as *Albert* only loads icons from local files and themes, not remote URLs
+            e = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+            try:
+                futures = [
+                    e.submit(download_item_icon, item, self.cache_dir, self._pool)
+                    if item.iconUrls[0].startswith('https:')
+                    else None
+                    for item in items
+                ]
+                # Add each item once its icon is ready, so results show up without waiting on every download
+                for item, future in zip(items, futures):
+                    if future is not None:
+                        try:
+                            future.result()
+                        except (HTTPException, OSError) as ex:
+                            critical(ex)
+                            item.iconUrls = [ICON_URL]
                     if not query.isValid:
                         return
-
-            for item in items:
-                query.add(item)
+                    query.add(item)
+            finally:
+                # Don't wait on pending downloads if the query was invalidated
+                e.shutdown(wait=False, cancel_futures=True)
 
             # Add a link to the *YouTube* page, in case there's more results, including results we didn't include
             item = StandardItem(